@@ -1,40 +1,191 @@
+import re
+from dataclasses import dataclass
+from typing import Callable
 import streamlit as st
+import numpy as np
 import pandas as pd
-from io import StringIO
-from datetime import datetime
+import pyarrow as pa
+from pandas.tseries.api import guess_datetime_format
+from io import BytesIO
 
 st.set_page_config(page_title="Mnarani Mpesa Statement to QuickBooks IIF", layout="wide")
 st.title("📄 Convert Mnarani Mpesa Statement to QuickBooks IIF")
 
-def fmt_date(dt):
-    """Return date formatted as MM/DD/YYYY, or fallback to string if not parseable."""
-    try:
-        # Use pandas to coerce many input types (Timestamp, date, string)
-        ts = pd.to_datetime(dt, errors="coerce")
-        if pd.isna(ts):
-            # fallback to original string representation
-            s = str(dt)
-            # try a final parse for formats like 'YYYY-MM-DD'
-            try:
-                return datetime.strptime(s.split()[0], "%Y-%m-%d").strftime("%m/%d/%Y")
-            except Exception:
-                return s
-        return ts.strftime("%d/%m/%Y")
-    except Exception:
-        return str(dt)
+# Details categories matched in one regex pass: (1) DTB settlement transfer, (2) merchant charge
+DETAILS_PATTERN = re.compile(r"(merchant account to organization settlement account)|^(pay merchant charge)$")
+
+@dataclass(frozen=True)
+class CategoryRule:
+    """How the rows of one transaction category are posted to QuickBooks."""
+    category: str                                   # Category value, or "payment" for Paid In rows
+    trnstype: str
+    amount: Callable[[pd.DataFrame], pd.Series]     # signed TRNS amount of a block
+    trns_accnt: str
+    trns_name: str
+    spl_accnt: str
+    spl_name: str
+    summary_memo: str                               # memo for the per-day summary transactions
+    always_summarize: bool = False
+
+# Posting rules, in IIF output order
+RULES = (
+    # 1️⃣ Payments from Walk In
+    CategoryRule(
+        "payment", "PAYMENT", lambda block: block['Paid In'],
+        "Mpesa Till", "Walk In", "Accounts Receivable", "Walk In",
+        "Walk In payments summary",
+    ),
+    # 2️⃣ DTB Transfers
+    CategoryRule(
+        "transfer", "TRANSFER", lambda block: -block['Withdrawn'].abs(),
+        "Mpesa Till", "Diamond Trust Bank", "Diamond Trust Bank", "Mpesa Till",
+        "DTB transfers summary",
+    ),
+    # 3️⃣ Pay merchant Charge → summarized by date
+    # Use Safaricom as vendor name for bank charges and the account as Bank Service Charges:Bank Charges - Mpesa
+    CategoryRule(
+        "mcharge", "CHECK", lambda block: -block['Withdrawn'],
+        "Mpesa Till", "Mpesa", "Bank Service Charges:Bank Charges - Mpesa", "Mpesa",
+        "Pay merchant Charge summary", always_summarize=True,
+    ),
+    # 4️⃣ Other Withdrawals → Bank Service Charges generic
+    # Use Safaricom as vendor (or you can decide a different vendor if available in Other Party Info)
+    CategoryRule(
+        "other", "CHECK", lambda block: -block['Withdrawn'],
+        "Mpesa Till", "Mpesa", "Bank Service Charges:Bank Charges - Mpesa", "Mpesa",
+        "Other withdrawals summary",
+    ),
+)
+
+def fmt_amounts(amounts):
+    """Format a Series of amounts with two decimals, like '{:.2f}', in one Arrow cast."""
+    values = amounts.to_numpy(dtype="float64")
+    if not np.isfinite(values).all():
+        raise ValueError("Statement contains a non-finite amount (inf or NaN); check the Paid In and Withdrawn columns")
+    # Streamlit already depends on pyarrow; the decimal cast rounds and formats in C++,
+    # and being a safe cast it raises on overflow instead of writing 0.00
+    formatted = pa.array(values).cast(pa.decimal128(38, 2)).cast(pa.string())
+    return pd.Series(formatted.to_numpy(zero_copy_only=False), index=amounts.index)
+
+def iif_lines(trnstype, dates, amounts, memos, trns_accnt, trns_name, spl_accnt, spl_name):
+    """Build the TRNS/SPL/ENDTRNS lines for a block of transactions as a single string.
+
+    `dates`, `amounts` and `memos` are aligned Series (`memos` may also be a single
+    string); `amounts` is the signed TRNS amount and the SPL line carries its negation.
+    """
+    if amounts.empty:
+        return ""
+    amount_str = fmt_amounts(amounts)
+    neg_str = fmt_amounts(-amounts)
+    trns = f"TRNS\t{trnstype}\t" + dates + f"\t{trns_accnt}\t{trns_name}\t" + amount_str + "\t" + memos + "\n"
+    spl = f"SPL\t{trnstype}\t" + dates + f"\t{spl_accnt}\t{spl_name}\t" + neg_str + "\t" + memos + "\n"
+    lines = np.column_stack([
+        trns.to_numpy(dtype=object),
+        spl.to_numpy(dtype=object),
+        np.full(len(trns), "ENDTRNS\n", dtype=object),
+    ]).ravel()
+    return "".join(lines)
+
+def daily_totals(block, amounts):
+    """Sum `amounts` per calendar day of the block, keeping each day's formatted Date."""
+    days = block['Completion Time'].dt.date
+    totals = pd.DataFrame({'Date': block['Date'], 'Amount': amounts}).groupby(days, dropna=False)
+    return totals.agg(Date=('Date', 'first'), Amount=('Amount', 'sum'))
+
+def category_lines(rule, block, summarize_by_day):
+    """Build a category's IIF lines, either per transaction or as one transaction per day."""
+    accounts = (rule.trns_accnt, rule.trns_name, rule.spl_accnt, rule.spl_name)
+    amounts = rule.amount(block)
+    if summarize_by_day or rule.always_summarize:
+        totals = daily_totals(block, amounts)
+        return iif_lines(rule.trnstype, totals['Date'], totals['Amount'], rule.summary_memo, *accounts)
+    return iif_lines(rule.trnstype, block['Date'], amounts, block['Memo'], *accounts)
+
+def iter_iif(blocks, summarize_by_day=False):
+    """Yield the IIF file in chunks: the header, then one chunk per transaction category."""
+    yield "!TRNS\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tMEMO\n"
+    yield "!SPL\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tMEMO\n"
+    yield "!ENDTRNS\n"
+    for rule in RULES:
+        yield category_lines(rule, blocks[rule.category], summarize_by_day)
+
+@st.cache_data(show_spinner=False)
+def build_iif(df, summarize_by_day=False):
+    """Return the full IIF file as UTF-8 bytes; cached so widget reruns skip regeneration."""
+    # str.join sums the chunk lengths and allocates the result once, so no buffer regrows;
+    # encoding here hands st.download_button bytes it can serve without another copy
+    return "".join(iter_iif(split_categories(df), summarize_by_day)).encode("utf-8")
+
+@st.cache_data(show_spinner=False)
+def load_statement(file_bytes, name):
+    """Read an uploaded statement and normalize its column names; cached on the file contents."""
+    # Drop first 6 rows (metadata) before reading
+    if name.lower().endswith(".csv"):
+        try:
+            # The pyarrow engine ignores skiprows alongside a header row, so point header past the metadata
+            df = pd.read_csv(BytesIO(file_bytes), header=6, engine="pyarrow", dtype_backend="pyarrow")
+        except (pa.ArrowInvalid, pd.errors.ParserError):
+            # pyarrow rejects short rows (footers, missing trailing fields); the C engine pads them with NaN
+            df = pd.read_csv(BytesIO(file_bytes), skiprows=6)
+    else:
+        try:
+            df = pd.read_excel(BytesIO(file_bytes), skiprows=6, engine="calamine")
+        except ImportError:
+            # python-calamine is optional; fall back to pandas' default openpyxl reader
+            df = pd.read_excel(BytesIO(file_bytes), skiprows=6)
+
+    # Normalize and clean column names
+    df.columns = df.columns.str.strip().str.replace(r"\s+", " ", regex=True)
+    return df
+
+def parse_completion_time(values):
+    """Parse Completion Time with an explicit format guessed from the data, so pandas uses its fast path."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return pd.to_datetime(values, errors='coerce')
+    fmt = None
+    for sample in values.dropna().astype(str).head(10):
+        fmt = guess_datetime_format(sample)
+        if fmt:
+            break
+    # "mixed" parses each value on its own, as pandas does when it cannot infer a format
+    return pd.to_datetime(values, format=fmt or "mixed", errors='coerce', cache=True)
+
+@st.cache_data(show_spinner=False)
+def prepare_statement(df):
+    """Convert the statement columns to the types the IIF writers expect."""
+    df['Completion Time'] = parse_completion_time(df['Completion Time'])
+    df['Date'] = df['Completion Time'].dt.strftime("%d/%m/%Y").fillna("NaT")
+    df['Paid In'] = pd.to_numeric(df['Paid In'], errors='coerce').fillna(0)
+    df['Withdrawn'] = pd.to_numeric(df['Withdrawn'], errors='coerce').fillna(0)
+    # Details only takes a handful of distinct values, so it is matched per category below
+    df['Details'] = df['Details'].astype("string").fillna('').str.strip().astype('category')
+    df['Other Party Info'] = df['Other Party Info'].astype("string").fillna('').str.strip()
+    df['Memo'] = df['Other Party Info'].str.cat(df['Details'].astype(str), sep=" | ").str.strip(" |")
+
+    # Categorize the withdrawal side of every row once; the Details matches take precedence over
+    # Withdrawn. Payments are picked from Paid In separately in split_categories, so a row with
+    # both (e.g. a refunded merchant charge) still posts its Paid In, as before.
+    # The regex only runs over the Details categories and is broadcast back through the codes.
+    categories = df['Details'].cat.categories.to_series().str.lower()
+    matched = categories.str.extract(DETAILS_PATTERN).notna().to_numpy()[df['Details'].cat.codes.to_numpy()]
+    df['Category'] = np.select(
+        [matched[:, 0], matched[:, 1], df['Withdrawn'] > 0],
+        ["transfer", "mcharge", "other"],
+        default="skip",
+    )
+    return df
+
+def split_categories(df):
+    """Return one frame per transaction category, with empty frames for categories not present."""
+    groups = dict(tuple(df.groupby('Category', sort=False)))
+    groups["payment"] = df[df['Paid In'] > 0]
+    return {rule.category: groups.get(rule.category, df.iloc[:0]) for rule in RULES}
 
 uploaded_file = st.file_uploader("Upload Mpesa statement (.csv or .xlsx)", type=["csv", "xlsx"])
 
 if uploaded_file:
     try:
-        # Drop first 6 rows (metadata) before reading
-        if uploaded_file.name.lower().endswith(".csv"):
-            df = pd.read_csv(uploaded_file, skiprows=6)
-        else:
-            df = pd.read_excel(uploaded_file, skiprows=6)
-
-        # Normalize and clean column names
-        df.columns = df.columns.str.strip().str.replace(r"\s+", " ", regex=True)
+        df = load_statement(uploaded_file.getvalue(), uploaded_file.name)
 
         # Required columns
         required_cols = {'Completion Time', 'Paid In', 'Withdrawn', 'Details', 'Other Party Info'}
@@ -48,79 +199,25 @@ if uploaded_file:
         st.dataframe(df.head())
 
         # Data type conversions
-        df['Completion Time'] = pd.to_datetime(df['Completion Time'], errors='coerce')
-        df['Paid In'] = pd.to_numeric(df['Paid In'], errors='coerce').fillna(0)
-        df['Withdrawn'] = pd.to_numeric(df['Withdrawn'], errors='coerce').fillna(0)
-        df['Details'] = df['Details'].astype(str)
-        df['Other Party Info'] = df['Other Party Info'].astype(str)
-
-        # Initialize IIF output
-        output = StringIO()
-        output.write("!TRNS\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tMEMO\n")
-        output.write("!SPL\tTRNSTYPE\tDATE\tACCNT\tNAME\tAMOUNT\tMEMO\n")
-        output.write("!ENDTRNS\n")
-
-        # 1️⃣ Payments from Walk In
-        payments_df = df[df['Paid In'] > 0]
-        for _, row in payments_df.iterrows():
-            date_str = fmt_date(row['Completion Time'])
-            memo = f"{row['Other Party Info']} | {row['Details']}".strip(" |")
-            amount = row['Paid In']
-
-            output.write(f"TRNS\tPAYMENT\t{date_str}\tMpesa Till\tWalk In\t{amount:.2f}\t{memo}\n")
-            output.write(f"SPL\tPAYMENT\t{date_str}\tAccounts Receivable\tWalk In\t{-amount:.2f}\t{memo}\n")
-            output.write("ENDTRNS\n")
-
-        # 2️⃣ DTB Transfers
-        transfers_df = df[df['Details'].str.lower().str.contains("merchant account to organization settlement account", na=False)]
-        for _, row in transfers_df.iterrows():
-            date_str = fmt_date(row['Completion Time'])
-            memo = f"{row['Other Party Info']} | {row['Details']}".strip(" |")
-            amount = abs(row['Withdrawn'])
-
-            output.write(f"TRNS\tTRANSFER\t{date_str}\tMpesa Till\tDiamond Trust Bank\t{-amount:.2f}\t{memo}\n")
-            output.write(f"SPL\tTRANSFER\t{date_str}\tDiamond Trust Bank\tMpesa Till\t{amount:.2f}\t{memo}\n")
-            output.write("ENDTRNS\n")
-
-        # 3️⃣ Pay merchant Charge → summarized by date
-        charges_df = df[df['Details'].str.strip().str.lower() == "pay merchant charge"]
-        if not charges_df.empty:
-            charges_summary = charges_df.groupby(charges_df['Completion Time'].dt.date)['Withdrawn'].sum().reset_index()
-            for _, row in charges_summary.iterrows():
-                # row['Completion Time'] here is a date object; format safely via fmt_date
-                date_str = fmt_date(row['Completion Time'])
-                memo = "Pay merchant Charge summary"
-                amount = row['Withdrawn']
-
-                # Use Safaricom as vendor name for bank charges and the account as Bank Service Charges:Bank Charges - Mpesa
-                output.write(f"TRNS\tCHECK\t{date_str}\tMpesa Till\tMpesa\t{-amount:.2f}\t{memo}\n")
-                output.write(f"SPL\tCHECK\t{date_str}\tBank Service Charges:Bank Charges - Mpesa\tMpesa\t{amount:.2f}\t{memo}\n")
-                output.write("ENDTRNS\n")
-
-        # 4️⃣ Other Withdrawals → Bank Service Charges generic
-        other_withdrawals = df[
-            (df['Withdrawn'] > 0) &
-            (~df['Details'].str.lower().str.contains("merchant account to organization settlement account", na=False)) &
-            (~df['Details'].str.strip().str.lower().eq("pay merchant charge"))
-        ]
-        for _, row in other_withdrawals.iterrows():
-            date_str = fmt_date(row['Completion Time'])
-            memo = f"{row['Other Party Info']} | {row['Details']}".strip(" |")
-            amount = row['Withdrawn']
-
-            # Use Safaricom as vendor (or you can decide a different vendor if available in Other Party Info)
-            output.write(f"TRNS\tCHECK\t{date_str}\tMpesa Till\tMpesa\t{-amount:.2f}\t{memo}\n")
-            output.write(f"SPL\tCHECK\t{date_str}\tBank Service Charges:Bank Charges - Mpesa\tMpesa\t{amount:.2f}\t{memo}\n")
-            output.write("ENDTRNS\n")
+        df = prepare_statement(df)
+
+        # Split the statement into its transaction categories
+        blocks = split_categories(df)
+
+        # Merchant charges are always summarized by date; the other categories optionally so
+        summarize_by_day = st.checkbox("Summarize transactions per day")
+
+        # Assemble the IIF file from the streamed chunks
+        iif_bytes = build_iif(df, summarize_by_day)
 
         # Totals
-        st.markdown(f"**Total Paid In:** KES {payments_df['Paid In'].sum():,.2f}")
+        st.markdown(f"**Total Paid In:** KES {blocks['payment']['Paid In'].sum():,.2f}")
         st.markdown(f"**Total Withdrawn:** KES {df['Withdrawn'].sum():,.2f}")
-        st.markdown(f"**Total 'Pay merchant Charge':** KES {charges_df['Withdrawn'].sum():,.2f}")
+        st.markdown(f"**Total 'Pay merchant Charge':** KES {blocks['mcharge']['Withdrawn'].sum():,.2f}")
 
         # Download button
         st.success("✅ IIF file generated successfully!")
-        st.download_button("📥 Download IIF File", data=output.getvalue(), file_name="mpesa_transactions.iif", mime="text/plain")
+        st.download_button("📥 Download IIF File", data=iif_bytes, file_name="mpesa_transactions.iif", mime="text/plain")
 
     except Exception as e:
         st.error(f"❌ Error processing file: {e}")